@@ -1,9 +1,19 @@
 import os
+import re
+import asyncio
 import logging
+import hashlib
+import functools
+import time
+import weakref
+import contextlib
+import secrets
 from typing import TypedDict, Annotated, List
 from dotenv import load_dotenv
 import threading
-from flask import Flask
+import httpx
+from cachetools import TTLCache
+from aiolimiter import AsyncLimiter
 import datetime
 import pytz
 
@@ -17,6 +27,15 @@ TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
+# Render sets this for web services; when present the bot runs on webhooks
+RENDER_EXTERNAL_HOSTNAME = os.getenv("RENDER_EXTERNAL_HOSTNAME")
+WEBHOOK_PATH = "/telegram/webhook"
+# Telegram echoes this back in a header, so only it can post updates to us
+WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+# Render assigns a port automatically via the 'PORT' env var
+PORT = int(os.environ.get("PORT", 8080))
+
 # Validate Keys
 if not all(
     [TELEGRAM_TOKEN, GOOGLE_API_KEY, PINECONE_API_KEY, TAVILY_API_KEY, GITHUB_TOKEN]
@@ -32,6 +51,12 @@ logger = logging.getLogger(__name__)
 
 # --- IMPORTS ---
 from telegram import Update
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+import uvicorn
 from telegram.ext import (
     ApplicationBuilder,
     ContextTypes,
@@ -40,27 +65,30 @@ from telegram.ext import (
     JobQueue,
     filters,
 )
-from github import Github
 from pinecone import Pinecone
 
 # LangChain Imports
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from langchain_community.tools.tavily_search import TavilySearchResults
-
-# Smart Import for Pinecone VectorStore
-try:
-    from langchain_pinecone import PineconeVectorStore
-except ImportError:
-    try:
-        from langchain_pinecone import Pinecone as PineconeVectorStore
-    except ImportError:
-        from langchain_community.vectorstores import Pinecone as PineconeVectorStore
 
 from langchain_core.tools import tool
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import (
+    BaseMessage,
+    HumanMessage,
+    AIMessage,
+    SystemMessage,
+    ToolMessage,
+)
 from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolNode
 from langgraph.graph.message import add_messages
+from langgraph.checkpoint.memory import MemorySaver
+
+# Optional: on-device query fingerprints for the semantic memory cache
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
 
 # --- 2. INITIALIZE SERVICES ---
 
@@ -72,48 +100,214 @@ except Exception as e:
     logger.error(f"Failed to connect to Pinecone: {e}")
     exit(1)
 
-# B. Initialize Embeddings & VectorStore
+# B. Initialize Embeddings
 embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
 
-try:
-    vectorstore = PineconeVectorStore(index=pinecone_index, embedding=embeddings)
-except TypeError:
-    vectorstore = PineconeVectorStore(index_name="pooya-bot", embedding=embeddings)
+
+class CachedEmbeddings(Embeddings):
+    """Remembers query embeddings for a while so repeated questions skip the API."""
+
+    def __init__(self, inner: Embeddings, maxsize: int = 2048, ttl: int = 900):
+        self._inner = inner
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Tools run concurrently in worker threads
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        with self._lock:
+            vector = self._cache.get(key)
+        if vector is not None:
+            return vector
+
+        vector = self._inner.embed_query(text)
+        with self._lock:
+            self._cache[key] = vector
+        return vector
+
+
+cached_embeddings = CachedEmbeddings(embeddings)
+
+
+class SemanticCache:
+    """Reuses a memory result when a new query means the same as a recent one."""
+
+    def __init__(
+        self, model, threshold: float = 0.95, maxsize: int = 512, ttl: int = 600
+    ):
+        self._model = model
+        self._threshold = threshold
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._vectors = None
+        self._results = []
+        self._stamps = []
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        now = time.monotonic()
+        keep = [i for i, t in enumerate(self._stamps) if now - t < self._ttl]
+        keep = keep[-self._maxsize :]
+        if len(keep) != len(self._stamps):
+            self._vectors = self._vectors[keep]
+            self._results = [self._results[i] for i in keep]
+            self._stamps = [self._stamps[i] for i in keep]
+
+    def lookup(self, query: str):
+        """Returns the query's fingerprint and a cached result (or None)."""
+        fingerprint = self._model.encode([query], normalize_embeddings=True)[0]
+        with self._lock:
+            self._prune()
+            if self._results:
+                sims = self._vectors @ fingerprint
+                best = int(np.argmax(sims))
+                if sims[best] > self._threshold:
+                    return fingerprint, self._results[best]
+        return fingerprint, None
+
+    def store(self, fingerprint, result):
+        with self._lock:
+            row = fingerprint[np.newaxis, :]
+            if self._vectors is None:
+                self._vectors = row
+            else:
+                self._vectors = np.vstack([self._vectors, row])
+            self._results.append(result)
+            self._stamps.append(time.monotonic())
+            self._prune()
+
+
+semantic_cache = None
+if SentenceTransformer is not None:
+    try:
+        semantic_cache = SemanticCache(SentenceTransformer("all-MiniLM-L6-v2"))
+    except Exception as e:
+        logger.warning(f"Semantic cache disabled: {e}")
+
+# C. Shared HTTP/2 Client for GitHub & Tavily (keeps TLS connections warm)
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50),
+    timeout=10.0,
+)
+
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+LATEST_REPOS_QUERY = """
+query {
+  viewer {
+    repositories(first: 3, orderBy: {field: PUSHED_AT, direction: DESC}) {
+      nodes { name url description }
+    }
+  }
+}
+"""
+
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
 
 # --- 3. DEFINE TOOLS ---
 
 
+def ttl_cached(ttl: int, maxsize: int = 256, ignore_query: bool = False):
+    """Caches a tool's result per (tool name, normalized query) for `ttl` seconds.
+
+    Error strings are not cached, so a flaky service is retried on the next call.
+    """
+
+    def decorator(fn):
+        cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        lock = threading.Lock()
+
+        @functools.wraps(fn)
+        def wrapper(query: str):
+            key = (fn.__name__, "" if ignore_query else query.strip().lower())
+            with lock:
+                if key in cache:
+                    return cache[key]
+
+            result = fn(query)
+            if not (isinstance(result, str) and result.startswith("Error")):
+                with lock:
+                    cache[key] = result
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+# Live-info questions the LLM still routes through memory; Pinecone never has these
+NON_PERSONAL_QUERY = re.compile(
+    r"\b(weather|temperature|news|current time|today'?s date)\b", re.IGNORECASE
+)
+
+
 @tool
+@ttl_cached(ttl=600)
 def check_my_memory(query: str):
     """
     ALWAYS use this FIRST. Search here for Pooya's personal opinions,
     past projects, resume, biography, or specific advice he has written.
     """
+    if len(query.strip()) < 4 or NON_PERSONAL_QUERY.search(query):
+        return "No specific personal memory found."
+
+    # The semantic cache is optional, so any failure in it falls through to Pinecone
+    fingerprint = None
+    if semantic_cache is not None:
+        try:
+            fingerprint, cached = semantic_cache.lookup(query)
+            if cached is not None:
+                return cached
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            fingerprint = None
+
     try:
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
-        docs = retriever.invoke(query)
-        if not docs:
-            return "No specific personal memory found."
-        return "\n\n".join([d.page_content for d in docs])
+        vector = cached_embeddings.embed_query(query)
+        res = pinecone_index.query(vector=vector, top_k=3, include_metadata=True)
+        texts = [
+            m["metadata"]["text"]
+            for m in res["matches"]
+            if m.get("metadata") and m["metadata"].get("text")
+        ]
+        result = "\n\n".join(texts) if texts else "No specific personal memory found."
     except Exception as e:
         return f"Error reading memory: {e}"
 
+    if fingerprint is not None:
+        try:
+            semantic_cache.store(fingerprint, result)
+        except Exception as e:
+            logger.warning(f"Semantic cache store failed: {e}")
+    return result
+
 
 @tool
+@ttl_cached(ttl=300, ignore_query=True)
 def check_github_activity(query: str):
     """
     Use this to see what Pooya is coding RIGHT NOW.
     Returns his latest repositories and commit messages.
     """
     try:
-        g = Github(GITHUB_TOKEN)
-        user = g.get_user()
-        repos = user.get_repos(sort="updated", direction="desc")[:3]
+        response = http_client.post(
+            GITHUB_GRAPHQL_URL,
+            json={"query": LATEST_REPOS_QUERY},
+            headers={"Authorization": f"Bearer {GITHUB_TOKEN}"},
+        )
+        response.raise_for_status()
+        payload = response.json()
+        if payload.get("errors"):
+            raise RuntimeError(payload["errors"][0].get("message", "GraphQL error"))
+        repos = payload["data"]["viewer"]["repositories"]["nodes"]
 
         info = []
         for repo in repos:
-            desc = repo.description if repo.description else "No description"
-            info.append(f"Repo: {repo.name} | URL: {repo.html_url} | Desc: {desc}")
+            desc = repo["description"] if repo["description"] else "No description"
+            info.append(f"Repo: {repo['name']} | URL: {repo['url']} | Desc: {desc}")
 
         if not info:
             return "No recent public repositories found."
@@ -123,20 +317,40 @@ def check_github_activity(query: str):
 
 
 # --- UPDATED: GENERAL WEB SEARCH TOOL ---
-# We use the raw Tavily tool directly so the LLM can search for ANYTHING (Weather, News, Pooya's LinkedIn)
-web_search_tool = TavilySearchResults(max_results=3)
-web_search_tool.name = "web_search"
-web_search_tool.description = """Use this to search the internet for live info (Weather, News, Map, etc) or public info about Pooya (LinkedIn/Instagram/Spotify).
-                              Pooya profiles are public, so feel free to look them up:
-                                - LinkedIn: https://www.linkedin.com/in/pooyanasiri
-                                - Instagram: https://www.instagram.com/pooyanasiri
-                                - Spotify: https://open.spotify.com/user/p007a
-                              """
-
-tools = [check_my_memory, check_github_activity, web_search_tool]
+# Calls the Tavily API directly so the LLM can search for ANYTHING (Weather, News, Pooya's LinkedIn)
+
+
+@tool
+@ttl_cached(ttl=120)
+def web_search(query: str):
+    """Use this to search the internet for live info (Weather, News, Map, etc) or public info about Pooya (LinkedIn/Instagram/Spotify).
+    Pooya profiles are public, so feel free to look them up:
+      - LinkedIn: https://www.linkedin.com/in/pooyanasiri
+      - Instagram: https://www.instagram.com/pooyanasiri
+      - Spotify: https://open.spotify.com/user/p007a
+    """
+    try:
+        response = http_client.post(
+            TAVILY_SEARCH_URL,
+            json={"api_key": TAVILY_API_KEY, "query": query, "max_results": 2},
+        )
+        response.raise_for_status()
+        results = response.json().get("results", [])
+        return [{"url": r["url"], "content": r["content"]} for r in results]
+    except Exception as e:
+        return f"Error searching the web: {e}"
+
+
+tools = [check_my_memory, check_github_activity, web_search]
+TOOL_MAP = {t.name: t for t in tools}
 
 # --- 4. THE BRAIN (AGENT SETUP) ---
 
+# Small, deterministic model that only decides which tools to call
+router_llm = ChatGoogleGenerativeAI(
+    model="gemini-2.5-flash-lite", temperature=0
+).bind_tools(tools)
+
 llm = ChatGoogleGenerativeAI(
     model="gemini-2.5-flash", temperature=0.7
 )  # Slightly higher temp for better "improv"
@@ -147,8 +361,82 @@ class AgentState(TypedDict):
     messages: Annotated[List[BaseMessage], add_messages]
 
 
-def chatbot_node(state: AgentState):
-    return {"messages": [llm_with_tools.invoke(state["messages"])]}
+# Keep the prompt from growing with every turn and every multi-KB tool result
+MAX_TOOL_CHARS = 2048
+MAX_HISTORY_MESSAGES = 20
+
+
+def bound_history(messages: List[BaseMessage]) -> List[BaseMessage]:
+    """Returns the prompt for the LLM: system prompt, recent turns, clipped tool output."""
+    system = [m for m in messages[:1] if isinstance(m, SystemMessage)]
+    rest = messages[len(system) :]
+
+    # Start the window on a user turn so no tool result loses its tool call
+    start = max(len(rest) - MAX_HISTORY_MESSAGES, 0)
+    while start < len(rest) and not isinstance(rest[start], HumanMessage):
+        start += 1
+    if start == len(rest):
+        human_turns = [i for i, m in enumerate(rest) if isinstance(m, HumanMessage)]
+        start = human_turns[-1] if human_turns else 0
+
+    bounded = []
+    for m in rest[start:]:
+        if isinstance(m, ToolMessage) and len(m.content) > MAX_TOOL_CHARS:
+            m = m.model_copy(
+                update={"content": m.content[:MAX_TOOL_CHARS] + "…[truncated]"}
+            )
+        bounded.append(m)
+    return system + bounded
+
+
+async def router_node(state: AgentState):
+    """Plans the first round of tool calls with the fast model.
+
+    A direct answer from the router is dropped so the main model writes every reply.
+    """
+    response = await router_llm.ainvoke(bound_history(state["messages"]))
+    if response.tool_calls:
+        return {"messages": [response]}
+    return {}
+
+
+async def chatbot_node(state: AgentState):
+    messages = bound_history(state["messages"])
+    return {"messages": [await llm_with_tools.ainvoke(messages)]}
+
+
+async def parallel_tool_node(state: AgentState):
+    """Runs every tool call of the last AI message concurrently.
+
+    The tools are blocking I/O (Pinecone, GitHub, Tavily); their `ainvoke`
+    runs each one in a worker thread and the whole batch is gathered at once.
+    """
+
+    async def run_tool(tool_call):
+        selected_tool = TOOL_MAP.get(tool_call["name"])
+        if selected_tool is None:
+            content = f"Error: unknown tool '{tool_call['name']}'."
+        else:
+            try:
+                content = await selected_tool.ainvoke(tool_call["args"])
+            except Exception as e:
+                content = f"Error running {tool_call['name']}: {e}"
+        return ToolMessage(
+            content=str(content),
+            name=tool_call["name"],
+            tool_call_id=tool_call["id"],
+        )
+
+    tool_calls = state["messages"][-1].tool_calls
+    results = await asyncio.gather(*[run_tool(tc) for tc in tool_calls])
+    return {"messages": list(results)}
+
+
+def route_after_router(state: AgentState):
+    last_message = state["messages"][-1]
+    if isinstance(last_message, AIMessage) and last_message.tool_calls:
+        return "tools"
+    return "agent"
 
 
 def should_continue(state: AgentState):
@@ -160,14 +448,74 @@ def should_continue(state: AgentState):
 
 # Graph Construction
 workflow = StateGraph(AgentState)
+workflow.add_node("router", router_node)
 workflow.add_node("agent", chatbot_node)
-workflow.add_node("tools", ToolNode(tools))
+workflow.add_node("tools", parallel_tool_node)
 
-workflow.set_entry_point("agent")
+workflow.set_entry_point("router")
+workflow.add_conditional_edges("router", route_after_router)
 workflow.add_conditional_edges("agent", should_continue)
 workflow.add_edge("tools", "agent")
 
-app_graph = workflow.compile()
+# Chats keep their history per thread; the daily digest is a stateless one-off
+checkpointer = MemorySaver()
+app_graph = workflow.compile(checkpointer=checkpointer)
+digest_graph = workflow.compile()
+
+
+# --- OUTBOUND TELEGRAM QUEUE ---
+# Telegram allows ~30 messages/sec per bot and ~1/sec per chat, so every
+# send and edit goes through one queue that respects both budgets.
+outbound_q: asyncio.Queue = asyncio.Queue()
+global_limiter = AsyncLimiter(28, 1)
+# A limiter only matters for about a second, so idle chats can be forgotten
+chat_limiters = TTLCache(maxsize=4096, ttl=600)
+_deliveries = set()
+
+
+async def send_text(chat_id, text, message_id=None):
+    """Queues a message (or an edit of `message_id`) and waits until it is sent."""
+    done = asyncio.get_running_loop().create_future()
+    await outbound_q.put((chat_id, text, message_id, done))
+    return await done
+
+
+def _chat_limiter(chat_id) -> AsyncLimiter:
+    limiter = chat_limiters.get(chat_id)
+    if limiter is None:
+        limiter = chat_limiters[chat_id] = AsyncLimiter(1, 1)
+    return limiter
+
+
+async def _deliver(bot, chat_id, text, message_id, done):
+    try:
+        async with _chat_limiter(chat_id), global_limiter:
+            while True:
+                try:
+                    if message_id is None:
+                        result = await bot.send_message(chat_id=chat_id, text=text)
+                    else:
+                        result = await bot.edit_message_text(
+                            text=text, chat_id=chat_id, message_id=message_id
+                        )
+                    break
+                except RetryAfter as e:
+                    logger.warning(f"Rate limited by Telegram for {e.retry_after}s")
+                    await asyncio.sleep(e.retry_after)
+        if not done.done():
+            done.set_result(result)
+    except Exception as e:
+        if not done.done():
+            done.set_exception(e)
+
+
+async def sender(bot):
+    """Drains the outbound queue; each chat waits on its own limiter only."""
+    while True:
+        chat_id, text, message_id, done = await outbound_q.get()
+        task = asyncio.create_task(_deliver(bot, chat_id, text, message_id, done))
+        _deliveries.add(task)
+        task.add_done_callback(_deliveries.discard)
 
 
 # --- DAILY UPDATE JOB ---
@@ -186,8 +534,9 @@ async def daily_update_callback(context: ContextTypes.DEFAULT_TYPE):
     update_query = "What is the top 3 global tech news headlines right now? Respond in Pooya's usual sarcastic third-person persona."
 
     # --- 2. Call the web_search tool ---
-    # We use the web_search tool directly to get the live data
-    search_result = web_search_tool.invoke(update_query)
+    # We use the web_search tool directly to get the live data (off the event loop,
+    # which also serves the health check)
+    search_result = await web_search.ainvoke(update_query)
 
     # --- 3. Prepare full message for the Agent's Brain (LLM) ---
     system_message = f"""You are Pooya Nasiri's AI Digital Twin. Your task is to synthesize the search result into a witty, sarcastic, and third-person daily report.
@@ -210,7 +559,7 @@ async def daily_update_callback(context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Run the agent to format the search results into Pooya's style
-        result = app_graph.invoke(
+        result = await digest_graph.ainvoke(
             {"messages": messages}, config={"recursion_limit": 10}
         )
 
@@ -229,26 +578,13 @@ async def daily_update_callback(context: ContextTypes.DEFAULT_TYPE):
         )
 
     # --- 5. Send the message ---
-    await context.bot.send_message(chat_id=CHAT_ID, text=bot_reply)
+    await send_text(CHAT_ID, bot_reply)
 
 
 # --- 5. TELEGRAM HANDLERS ---
 
-
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_text = update.message.text
-    chat_id = update.effective_chat.id
-
-    if not user_text or not user_text.strip():
-        await context.bot.send_message(
-            chat_id=chat_id, text="Please send a valid text message."
-        )
-        return
-
-    await context.bot.send_chat_action(chat_id=chat_id, action="typing")
-
-    # --- UPDATED SYSTEM PROMPT ---
-    system_message = """You are the AI Digital Twin of **Pooya Nasiri**. You are a developer, a mentor, and a digital secretary.
+# --- UPDATED SYSTEM PROMPT ---
+SYSTEM_PROMPT = """You are the AI Digital Twin of **Pooya Nasiri**. You are a developer, a mentor, and a digital secretary.
 
     **CORE IDENTITY & TONE:**
     1. **The Persona:** You are friendly, tech-savvy, and warm, but your defining characteristic is **SARCASM**. You love a good joke, you are witty, and you often poke fun at the user's questions before helping them.
@@ -272,68 +608,245 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     - **Always provide an answer**, even if it's a sarcastic life tip based on general logic.
     """
 
-    messages = [SystemMessage(content=system_message), HumanMessage(content=user_text)]
 
-    try:
-        # Invoke the Agent
-        result = app_graph.invoke(
-            {"messages": messages}, config={"recursion_limit": 10}
+@functools.lru_cache(maxsize=1)
+def _sys() -> SystemMessage:
+    """The one shared SystemMessage, so every thread seeds the same object."""
+    return SystemMessage(content=SYSTEM_PROMPT)
+
+
+# Matches the per-chat send budget, so streaming edits never queue behind each other
+STREAM_EDIT_INTERVAL = 1.0
+
+
+def extract_text(content) -> str:
+    """Flattens a (possibly multi-part) Gemini message content into plain text."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            part if isinstance(part, str) else part.get("text", "")
+            for part in content
+            if isinstance(part, (str, dict))
         )
+    return ""
 
-        final_message = result["messages"][-1]
 
-        # Robust Text Extraction
-        if isinstance(final_message.content, list) and len(final_message.content) > 0:
-            if (
-                isinstance(final_message.content[0], dict)
-                and "text" in final_message.content[0]
-            ):
-                bot_reply = final_message.content[0]["text"]
-            else:
-                bot_reply = str(final_message.content)
-        elif isinstance(final_message.content, str):
-            bot_reply = final_message.content
-        else:
+# One lock per chat; it disappears once no turn in that chat holds or awaits it
+_chat_locks = weakref.WeakValueDictionary()
+
+
+def chat_lock(chat_id) -> asyncio.Lock:
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+
+# MemorySaver keeps every checkpoint forever, so each chat is compacted to a
+# single bounded checkpoint after its turn and idle chats are dropped
+THREAD_IDLE_TTL = 3600
+MAX_THREADS = 512
+_thread_last_seen = {}
+
+
+async def compact_thread(config, messages: List[BaseMessage]):
+    """Replaces all of a thread's checkpoints with one holding `messages`."""
+    await checkpointer.adelete_thread(config["configurable"]["thread_id"])
+    if messages:
+        await app_graph.aupdate_state(config, {"messages": messages}, as_node="agent")
+
+
+async def forget_idle_chats():
+    """Deletes threads idle past THREAD_IDLE_TTL, then the oldest beyond MAX_THREADS."""
+    now = time.monotonic()
+    by_age = sorted(_thread_last_seen.items(), key=lambda item: item[1])
+    excess = len(by_age) - MAX_THREADS
+    for i, (chat_id, last_seen) in enumerate(by_age):
+        if i >= excess and now - last_seen < THREAD_IDLE_TTL:
+            break
+        lock = _chat_locks.get(chat_id)
+        if lock is not None and lock.locked():
+            continue
+        del _thread_last_seen[chat_id]
+        await checkpointer.adelete_thread(str(chat_id))
+
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_text = update.message.text
+    chat_id = update.effective_chat.id
+
+    if not user_text or not user_text.strip():
+        await send_text(chat_id, "Please send a valid text message.")
+        return
+
+    # Updates run concurrently, so messages in one chat wait for its thread
+    lock = chat_lock(chat_id)
+    async with lock:
+        try:
+            await answer(context, chat_id, user_text)
+        finally:
+            # The thread may be checkpointed even if the final edit raised
+            _thread_last_seen[chat_id] = time.monotonic()
+    await forget_idle_chats()
+
+
+async def answer(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_text: str):
+    """Runs one agent turn for a chat and streams the reply into Telegram."""
+    await context.bot.send_chat_action(chat_id=chat_id, action="typing")
+
+    # Each chat is its own thread; the system prompt is only seeded once
+    config = {"configurable": {"thread_id": str(chat_id)}, "recursion_limit": 10}
+    state = await app_graph.aget_state(config)
+    history = state.values.get("messages", [])
+    messages = [HumanMessage(content=user_text)]
+    if not history:
+        messages.insert(0, _sys())
+
+    # Send a placeholder right away and fill it in as the answer streams
+    placeholder = await send_text(chat_id, "…")
+    shown_text = placeholder.text
+    last_edit = time.monotonic()
+    bot_reply = ""
+
+    try:
+        # Stream the Agent
+        async for event in app_graph.astream_events(
+            {"messages": messages}, config=config, version="v2"
+        ):
+            # Only the main model's reply is shown; the router never talks
+            if event["metadata"].get("langgraph_node") != "agent":
+                continue
+            if event["event"] == "on_chat_model_start":
+                # A new LLM call supersedes any text emitted before tool calls
+                bot_reply = ""
+            elif event["event"] == "on_chat_model_stream":
+                bot_reply += extract_text(event["data"]["chunk"].content)
+                now = time.monotonic()
+                if (
+                    bot_reply.strip()
+                    and bot_reply != shown_text
+                    and now - last_edit >= STREAM_EDIT_INTERVAL
+                ):
+                    try:
+                        await send_text(chat_id, bot_reply, placeholder.message_id)
+                        shown_text = bot_reply
+                    except Exception as e:
+                        logger.warning(f"Streaming edit failed: {e}")
+                    last_edit = now
+
+        if not bot_reply.strip():
             bot_reply = "I'm thinking, but I couldn't formulate a text response."
+        turn_ok = True
 
     except Exception as e:
         logger.error(f"Error processing message: {e}")
         bot_reply = "Sorry, I encountered an internal error. Please try again."
+        turn_ok = False
 
-    await context.bot.send_message(chat_id=chat_id, text=bot_reply)
+    # Keep only the bounded history of this chat in the checkpointer; a failed
+    # turn is rolled back so no half-finished tool call poisons later turns
+    try:
+        if turn_ok:
+            state = await app_graph.aget_state(config)
+            history = state.values.get("messages", [])
+        await compact_thread(config, bound_history(history))
+    except Exception as e:
+        logger.warning(f"Failed to compact chat history: {e}")
 
+    if bot_reply != shown_text:
+        await send_text(chat_id, bot_reply, placeholder.message_id)
 
-# --- 6. FLASK SERVER FOR CLOUD DEPLOYMENT ---
-app = Flask(__name__)
 
+# --- 6. ASGI SERVER FOR CLOUD DEPLOYMENT ---
+async def health_check(request):
+    return PlainTextResponse("PooyaBot is running!")
 
-@app.route("/")
-def health_check():
-    return "PooyaBot is running!", 200
 
+async def telegram_webhook(request):
+    """Hands updates pushed by Telegram straight to the bot's update queue."""
+    application = request.app.state.application
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not secrets.compare_digest(token, WEBHOOK_SECRET):
+        return Response(status_code=403)
 
-def run_flask():
-    # Render assigns a port automatically via the 'PORT' env var
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except (ValueError, KeyError, TypeError):
+        return Response(status_code=400)
+    await application.update_queue.put(update)
+    return Response()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Starts the bot with the web server and stops it before uvicorn exits."""
+    application = app.state.application
+    async with application:
+        sender_task = asyncio.create_task(sender(application.bot))
+        if RENDER_EXTERNAL_HOSTNAME:
+            await application.bot.set_webhook(
+                url=f"https://{RENDER_EXTERNAL_HOSTNAME}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+            )
+        else:
+            # Local development has no public URL, so fall back to polling
+            await application.updater.start_polling()
+        await application.start()
+        print(f"✅ Pooya Bot is Online and Ready! (Listening on port {PORT})")
+
+        yield
+
+        if application.updater:
+            await application.updater.stop()
+        await application.stop()
+        sender_task.cancel()
+
+
+web_app = Starlette(
+    routes=[
+        Route("/", health_check),
+        Route(WEBHOOK_PATH, telegram_webhook, methods=["POST"]),
+    ],
+    lifespan=lifespan,
+)
 
 
 async def save_chat_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Saves the user's chat ID to bot_data for scheduled messages."""
     context.application.bot_data["main_chat_id"] = update.effective_chat.id
-    await update.message.reply_text(
-        "Chat ID saved. Pooya's daily news is now scheduled on 9AM everyday!"
+    await send_text(
+        update.effective_chat.id,
+        "Chat ID saved. Pooya's daily news is now scheduled on 9AM everyday!",
     )
 
 
-if __name__ == "__main__":
-    # 1. Start the Flask Server in a background thread (Keep-Alive)
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
+async def main(application):
+    """Runs the bot and the keep-alive web server on the same event loop."""
+    web_app.state.application = application
+    server = uvicorn.Server(
+        uvicorn.Config(web_app, host="0.0.0.0", port=PORT, access_log=False)
+    )
+    # Serves until Render (or Ctrl+C) asks the process to stop; the bot is
+    # started and stopped by the app's lifespan, before serve() returns
+    await server.serve()
 
-    # 2. Start the Telegram Bot (Main Process)
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+
+if __name__ == "__main__":
+    # 1. Build the Telegram Bot
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .request(HTTPXRequest(http_version="2", connection_pool_size=64))
+        # Let other users' messages run while one agent turn is in flight
+        .concurrent_updates(True)
+    )
+    if RENDER_EXTERNAL_HOSTNAME:
+        # Telegram pushes updates to our webhook, so no polling Updater is needed
+        builder = builder.updater(None)
+    else:
+        builder = builder.get_updates_request(HTTPXRequest(http_version="2"))
+    application = builder.build()
 
     # Get JobQueue from the application
     job_queue = application.job_queue
@@ -356,7 +869,5 @@ if __name__ == "__main__":
         MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message)
     )
 
-    print(
-        f"✅ Pooya Bot is Online and Ready! (Listening on port {os.environ.get('PORT', 8080)})"
-    )
-    application.run_polling()
+    # 2. Start the Bot & Keep-Alive Server
+    asyncio.run(main(application))
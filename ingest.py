@@ -1,13 +1,20 @@
 import os
+from uuid import uuid4
 from dotenv import load_dotenv
 from langchain_community.document_loaders import DirectoryLoader, TextLoader, PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores import Pinecone as PineconeVectorStore
+from pinecone import Pinecone
 
 # Load environment variables
 load_dotenv()
 
+BATCH_SIZE = 100  # Gemini embeds up to 100 texts per request
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 def ingest():
     print("--- 1. Loading Your 'Brain' (Data) ---")
     # Load TXT and PDF files from 'data' folder
@@ -26,13 +33,21 @@ def ingest():
     
     print("--- 3. Saving to Pinecone Memory ---")
     embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
+    pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+    index = pc.Index("pooya-bot", pool_threads=4)
+    
+    # Embed in batches and push to Pinecone without waiting on each upsert
+    pending = []
+    for batch in chunked(splits, BATCH_SIZE):
+        vectors = embeddings.embed_documents([d.page_content for d in batch])
+        records = [
+            (uuid4().hex, vector, {**d.metadata, "text": d.page_content})
+            for d, vector in zip(batch, vectors)
+        ]
+        pending.append(index.upsert(vectors=records, async_req=True))
     
-    # Push to Pinecone
-    PineconeVectorStore.from_documents(
-        documents=splits, 
-        embedding=embeddings, 
-        index_name="pooya-bot"
-    )
+    for upsert in pending:
+        upsert.get()
     print("--- Done! Your Digital Twin has learned. ---")
 
 if __name__ == "__main__":